@@ -1,8 +1,24 @@
+import csv
+import hashlib
+import math
 import os
 import sys
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
 from pymongo import MongoClient
+from pymongo.errors import ConnectionFailure, OperationFailure
 import polars as pl
+import pyarrow as pa
+import pyarrow.compute as pc
+
+try:
+    from pymongoarrow.api import find_arrow_all
+    from pymongoarrow.schema import Schema
+except ImportError:  # repli : lecture du curseur en listes Python
+    find_arrow_all = None
+
+# Moteur streaming par défaut pour les collect() et sink_csv()
+pl.Config.set_engine_affinity("streaming")
 
 
 DB_NAME = "P7MLO"
@@ -11,6 +27,18 @@ COLL_NAME = "listings"
 OUTDIR = os.getenv("OUTDIR", "/app/outputs")
 TOP_N = int(os.getenv("TOP_N", "5"))
 NETTOYER_OUTPUTS = os.getenv("NETTOYER_OUTPUTS", "0") == "1"
+# Agrégations calculées par MongoDB ($median nécessite MongoDB 7.0+).
+# AGREGATION_MONGO=0 : rapatrie les documents et agrège avec Polars.
+AGREGATION_MONGO = os.getenv("AGREGATION_MONGO", "1") == "1"
+TAILLE_LOT = int(os.getenv("TAILLE_LOT", "10000"))
+NB_LECTEURS = int(os.getenv("NB_LECTEURS", "4"))
+# Médianes t2/t3 approchées par t-digest (une passe, erreur < 1 % sur de gros
+# volumes) ; MEDIANE_EXACTE=1 pour la médiane exacte, au prix d'un tri.
+# Côté MongoDB : $median approché, ou $push + $sortArray en mode exact.
+MEDIANE_EXACTE = os.getenv("MEDIANE_EXACTE", "0") == "1"
+# Base nettoyée conservée en Parquet, réutilisée tant que le dernier
+# last_scraped en base et le schéma n'ont pas changé
+CACHE_EXTRACTION = os.getenv("CACHE_EXTRACTION", "1") == "1"
 
 MONGO_URI = os.getenv("MONGO_URI", "").strip()
 MONGO_HOST = os.getenv("MONGO_HOST", "localhost").strip()
@@ -19,6 +47,16 @@ MONGO_AUTH_SOURCE = os.getenv("MONGO_AUTH_SOURCE", "admin").strip()
 MONGO_USER = os.getenv("MONGO_USER", "").strip()
 MONGO_PASS = os.getenv("MONGO_PASS", "").strip()
 
+# Compression du protocole (zstd si le serveur l'annonce, MongoDB 4.2+, sinon
+# zlib) et pool dimensionné pour les lectures et agrégations parallèles
+MONGO_OPTIONS = {
+    "serverSelectionTimeoutMS": 5000,
+    "compressors": "zstd,zlib",
+    "zlibCompressionLevel": 3,
+    "maxPoolSize": 32,
+    "socketTimeoutMS": 120000,
+}
+
 PROJECTION = {
     "_id": 0,
     "last_scraped": 1,
@@ -29,6 +67,66 @@ PROJECTION = {
     "neighbourhood_cleansed": 1,
 }
 
+# Schéma explicite : pas d'inférence sur l'ensemble des documents
+SCHEMA = {
+    "last_scraped": pl.Utf8,
+    "room_type": pl.Utf8,
+    "availability_30": pl.Int64,
+    "number_of_reviews": pl.Int64,
+    "host_is_superhost": pl.Utf8,
+    "neighbourhood_cleansed": pl.Utf8,
+}
+
+# Même schéma pour PyMongoArrow : BSON décodé directement en colonnes Arrow
+SCHEMA_ARROW = Schema({
+    "last_scraped": pa.string(),
+    "room_type": pa.string(),
+    "availability_30": pa.int64(),
+    "number_of_reviews": pa.int64(),
+    "host_is_superhost": pa.string(),
+    "neighbourhood_cleansed": pa.string(),
+}) if find_arrow_all else None
+
+# Index couvrant PROJECTION : find() servi par IXSCAN seul, sans FETCH
+# (_id exclu de la projection, sinon la requête n'est plus couverte)
+INDEX_KPI = "covered_kpi"
+INDEX_KPI_CLES = [
+    ("last_scraped", 1),
+    ("room_type", 1),
+    ("neighbourhood_cleansed", 1),
+    ("availability_30", 1),
+    ("number_of_reviews", 1),
+    ("host_is_superhost", 1),
+]
+
+# Nettoyage données critiques, évalué par MongoDB pour find() comme pour
+# aggregate() : les documents invalides ne transitent pas. Tous ces champs
+# sont dans covered_kpi, le filtre s'applique sur les clés d'index.
+FILTRE_VALIDES = {
+    "last_scraped": {"$ne": None},
+    "room_type": {"$ne": None},
+    "availability_30": {"$gte": 0, "$lte": 30},
+    "neighbourhood_cleansed": {"$regex": r"^(?!\[)(?!\d+$).{3,}"},
+}
+
+TRADUCTION_TYPE_LOGEMENT = {
+    "Entire home/apt": "Logement entier",
+    "Private room": "Chambre privée",
+    "Shared room": "Chambre partagée",
+    "Hotel room": "Chambre d’hôtel",
+}
+
+LIBELLES_CATEGORIE_HOTE = {
+    True: "Superhôte",
+    False: "Non superhôte",
+}
+
+FICHIER_T1 = "01_taux_reservation_moyen_par_mois_et_type_logement.csv"
+FICHIER_T2 = "02_mediane_nombre_avis_tous_logements.csv"
+FICHIER_T3 = "03_mediane_nombre_avis_par_categorie_hote.csv"
+FICHIER_T4 = "04_densite_logements_par_quartier.csv"
+FICHIER_T5 = "05_top_quartiers_taux_reservation_par_mois.csv"
+
 
 def die(msg: str, code: int = 1):
     print(f"[ERREUR] {msg}", file=sys.stderr)
@@ -52,135 +150,496 @@ def build_mongo_uri() -> str:
 
 
 def nettoyer_outputs(outdir: str):
-    p = Path(outdir)
-    if not p.exists():
+    # scandir : nom et type lus dans l'entrée de répertoire, sans objet Path
+    try:
+        with os.scandir(outdir) as entrees:
+            for e in entrees:
+                if e.name.endswith(".csv") and e.is_file(follow_symlinks=False):
+                    try:
+                        os.unlink(e.path)
+                    except OSError:
+                        pass
+    except FileNotFoundError:
         return
-    for f in p.glob("*.csv"):
-        try:
-            f.unlink()
-        except Exception:
-            pass
 
 
-def main():
-    os.makedirs(OUTDIR, exist_ok=True)
+def ecrire_csv(chemin: str, entetes: list, lignes):
+    with open(chemin, "w", newline="", encoding="utf-8") as f:
+        w = csv.writer(f, lineterminator="\n")
+        w.writerow(entetes)
+        w.writerows(lignes)
 
-    if NETTOYER_OUTPUTS:
-        nettoyer_outputs(OUTDIR)
-
-    uri = build_mongo_uri()
 
+def creer_index_kpi(coll) -> bool:
+    # Idempotent ; un utilisateur en lecture seule garde le scan complet
     try:
-        client = MongoClient(uri, serverSelectionTimeoutMS=5000)
-        client.admin.command("ping")
-    except Exception as e:
-        die(f"Connexion MongoDB impossible : {e}")
+        coll.create_index(INDEX_KPI_CLES, name=INDEX_KPI)
+    except OperationFailure as e:
+        if e.code == 18:  # AuthenticationFailed : traité par main()
+            raise
+        print(f"[ATTENTION] Index {INDEX_KPI} non créé : {e}", file=sys.stderr)
+        return False
+    return True
 
-    coll = client[DB_NAME][COLL_NAME]
-    print(f"[INFO] Mongo OK | base={DB_NAME} collection={COLL_NAME}")
 
-    docs = list(coll.find({}, PROJECTION))
-    if not docs:
-        die("Aucun document retourné.")
+def traduire_type_logement() -> pl.Expr:
+    # Une recherche dans une table de hachage par ligne ; valeurs inconnues gardées
+    return pl.col("room_type").replace(TRADUCTION_TYPE_LOGEMENT).alias("type_logement")
 
-    df = pl.from_dicts(docs, infer_schema_length=None)
 
-    # Typage
-    df = df.with_columns([
-        pl.col("last_scraped").cast(pl.Utf8, strict=False).str.strptime(pl.Date, strict=False),
-        pl.col("availability_30").cast(pl.Int64, strict=False),
-        pl.col("number_of_reviews").cast(pl.Int64, strict=False),
-        pl.col("host_is_superhost").cast(pl.Utf8, strict=False),
-        pl.col("room_type").cast(pl.Utf8, strict=False),
-        pl.col("neighbourhood_cleansed").cast(pl.Utf8, strict=False),
-    ])
+def libeller_categorie_hote() -> pl.Expr:
+    # Libellé posé sur les deux lignes agrégées, pas sur chaque annonce
+    return (
+        pl.col("est_superhote")
+        .replace_strict(LIBELLES_CATEGORIE_HOTE, return_dtype=pl.Utf8)
+        .alias("categorie_hote")
+    )
 
-    # Nettoyage données critiques
-    df = df.drop_nulls([
-        "last_scraped",
-        "room_type",
-        "availability_30",
-        "neighbourhood_cleansed",
-    ])
 
-    df = df.filter(
-        (pl.col("availability_30") >= 0) &
-        (pl.col("availability_30") <= 30)
-    )
+def mediane(valeurs: pa.ChunkedArray):
+    if MEDIANE_EXACTE:
+        return pc.quantile(valeurs, q=0.5)[0].as_py()
+    return pc.approximate_median(valeurs).as_py()
+
 
-    df = df.filter(
-        (pl.col("neighbourhood_cleansed").str.len_chars() > 2) &
-        (~pl.col("neighbourhood_cleansed").str.contains(r"^\[")) &
-        (~pl.col("neighbourhood_cleansed").str.contains(r"^\d+$"))
+def formater_mois() -> pl.Expr:
+    # cle_mois (AAAAMM entier) -> "AAAA-MM", uniquement sur les résultats
+    return (
+        (pl.col("cle_mois") // 100).cast(pl.Utf8) + "-"
+        + (pl.col("cle_mois") % 100).cast(pl.Utf8).str.zfill(2)
+    ).alias("mois")
+
+
+def etapes_nettoyage() -> list:
+    # Filtre + KPI + mois ; les dates illisibles sont écartées comme en Polars
+    return [
+        {"$match": FILTRE_VALIDES},
+        {"$addFields": {
+            "taux_reservation_30j": {
+                "$divide": [{"$subtract": [30, "$availability_30"]}, 30]
+            },
+            "date_releve": {"$convert": {
+                "input": "$last_scraped",
+                "to": "date",
+                "onError": None,
+                "onNull": None,
+            }},
+        }},
+        {"$addFields": {
+            "cle_mois": {"$add": [
+                {"$multiply": [{"$year": "$date_releve"}, 100]},
+                {"$month": "$date_releve"},
+            ]},
+        }},
+        {"$match": {"cle_mois": {"$ne": None}}},
+    ]
+
+
+def accumuler_mediane(champ: str) -> dict:
+    if not MEDIANE_EXACTE:
+        return {"$median": {"input": champ, "method": "approximate"}}
+    # Mode exact : valeurs du groupe collectées, médiane calculée ensuite
+    return {"$push": champ}
+
+
+def etapes_mediane_exacte(champ: str) -> list:
+    if not MEDIANE_EXACTE:
+        return []
+    # Tri du tableau puis moyenne des deux éléments centraux (un seul si impair),
+    # comme la médiane interpolée de Polars / pc.quantile
+    valeurs = {"$sortArray": {
+        "input": {"$filter": {"input": f"${champ}", "cond": {"$isNumber": "$$this"}}},
+        "sortBy": 1,
+    }}
+    return [{"$addFields": {champ: {"$let": {
+        "vars": {"v": valeurs},
+        "in": {"$let": {
+            "vars": {"n": {"$size": "$$v"}},
+            "in": {"$cond": [
+                {"$eq": ["$$n", 0]},
+                None,
+                {"$avg": [
+                    {"$arrayElemAt": [
+                        "$$v", {"$toInt": {"$floor": {"$divide": [{"$subtract": ["$$n", 1]}, 2]}}},
+                    ]},
+                    {"$arrayElemAt": [
+                        "$$v", {"$toInt": {"$floor": {"$divide": ["$$n", 2]}}},
+                    ]},
+                ]},
+            ]},
+        }},
+    }}}}]
+
+
+def agreger(coll, pipeline: list, schema: dict) -> pl.DataFrame:
+    docs = list(coll.aggregate(etapes_nettoyage() + pipeline, allowDiskUse=True))
+    return pl.from_dicts(docs, schema=schema, strict=False)
+
+
+def exporter_mongo_t1(coll):
+    (
+        agreger(coll, [
+            {"$group": {
+                "_id": {"cle_mois": "$cle_mois", "room_type": "$room_type"},
+                "taux_reservation_moyen": {"$avg": "$taux_reservation_30j"},
+            }},
+            {"$project": {
+                "_id": 0,
+                "cle_mois": "$_id.cle_mois",
+                "room_type": "$_id.room_type",
+                "taux_reservation_moyen": 1,
+            }},
+        ], {
+            "cle_mois": pl.Int32,
+            "room_type": pl.Utf8,
+            "taux_reservation_moyen": pl.Float64,
+        })
+        .with_columns(traduire_type_logement())
+        .sort(["cle_mois", "type_logement"])
+        .select([formater_mois(), "type_logement", "taux_reservation_moyen"])
+        .write_csv(f"{OUTDIR}/{FICHIER_T1}")
     )
 
-    # KPI
-    df = df.with_columns([
-        ((30 - pl.col("availability_30")) / 30).alias("taux_reservation_30j"),
-        pl.col("last_scraped").dt.strftime("%Y-%m").alias("mois"),
-    ])
 
-    # Traduction room_type
-    df = df.with_columns(
-        pl.when(pl.col("room_type") == "Entire home/apt").then(pl.lit("Logement entier"))
-        .when(pl.col("room_type") == "Private room").then(pl.lit("Chambre privée"))
-        .when(pl.col("room_type") == "Shared room").then(pl.lit("Chambre partagée"))
-        .when(pl.col("room_type") == "Hotel room").then(pl.lit("Chambre d’hôtel"))
-        .otherwise(pl.col("room_type"))
-        .alias("type_logement")
-    ).drop("room_type")
+def exporter_mongo_t2(coll):
+    (
+        agreger(coll, [
+            {"$group": {
+                "_id": None,
+                "mediane_nombre_avis": accumuler_mediane("$number_of_reviews"),
+            }},
+            *etapes_mediane_exacte("mediane_nombre_avis"),
+            {"$project": {"_id": 0, "mediane_nombre_avis": 1}},
+        ], {"mediane_nombre_avis": pl.Float64})
+        .write_csv(f"{OUTDIR}/{FICHIER_T2}")
+    )
 
-    # 1
+
+def exporter_mongo_t3(coll):
     (
-        df.group_by(["mois", "type_logement"])
-        .agg(pl.col("taux_reservation_30j").mean().alias("taux_reservation_moyen"))
-        .sort(["mois", "type_logement"])
-        .write_csv(f"{OUTDIR}/01_taux_reservation_moyen_par_mois_et_type_logement.csv")
+        agreger(coll, [
+            {"$group": {
+                "_id": {"$eq": ["$host_is_superhost", "t"]},
+                "mediane_nombre_avis": accumuler_mediane("$number_of_reviews"),
+            }},
+            *etapes_mediane_exacte("mediane_nombre_avis"),
+            {"$project": {
+                "_id": 0,
+                "est_superhote": "$_id",
+                "mediane_nombre_avis": 1,
+            }},
+        ], {"est_superhote": pl.Boolean, "mediane_nombre_avis": pl.Float64})
+        .select([libeller_categorie_hote(), "mediane_nombre_avis"])
+        .write_csv(f"{OUTDIR}/{FICHIER_T3}")
     )
 
-    # 2
+
+def exporter_mongo_t4(coll):
     (
-        df.select(pl.col("number_of_reviews").median().alias("mediane_nombre_avis"))
-        .write_csv(f"{OUTDIR}/02_mediane_nombre_avis_tous_logements.csv")
+        agreger(coll, [
+            {"$group": {
+                "_id": "$neighbourhood_cleansed",
+                "nombre_annonces": {"$sum": 1},
+            }},
+            {"$sort": {"nombre_annonces": -1}},
+            {"$project": {"_id": 0, "quartier": "$_id", "nombre_annonces": 1}},
+        ], {"quartier": pl.Utf8, "nombre_annonces": pl.UInt32})
+        .write_csv(f"{OUTDIR}/{FICHIER_T4}")
     )
 
-    # 3
+
+def exporter_mongo_t5(coll):
     (
-        df.with_columns(
-            pl.when(pl.col("host_is_superhost") == "t")
-            .then(pl.lit("Superhôte"))
-            .otherwise(pl.lit("Non superhôte"))
-            .alias("categorie_hote")
+        agreger(coll, [
+            {"$group": {
+                "_id": {
+                    "cle_mois": "$cle_mois",
+                    "quartier": "$neighbourhood_cleansed",
+                },
+                "taux_reservation_moyen": {"$avg": "$taux_reservation_30j"},
+            }},
+            # TOP_N meilleurs quartiers par mois, sans trier chaque mois en entier
+            {"$group": {
+                "_id": "$_id.cle_mois",
+                "top": {"$topN": {
+                    "n": TOP_N,
+                    "sortBy": {"taux_reservation_moyen": -1},
+                    "output": {
+                        "quartier": "$_id.quartier",
+                        "taux_reservation_moyen": "$taux_reservation_moyen",
+                    },
+                }},
+            }},
+            {"$unwind": "$top"},
+            {"$setWindowFields": {
+                "partitionBy": "$_id",
+                "sortBy": {"top.taux_reservation_moyen": -1},
+                "output": {"rang": {"$denseRank": {}}},
+            }},
+            {"$sort": {"_id": 1, "rang": 1}},
+            {"$project": {
+                "_id": 0,
+                "cle_mois": "$_id",
+                "quartier": "$top.quartier",
+                "taux_reservation_moyen": "$top.taux_reservation_moyen",
+                "rang": 1,
+            }},
+        ], {
+            "cle_mois": pl.Int32,
+            "quartier": pl.Utf8,
+            "taux_reservation_moyen": pl.Float64,
+            "rang": pl.UInt32,
+        })
+        .select([formater_mois(), pl.exclude("cle_mois")])
+        .write_csv(f"{OUTDIR}/{FICHIER_T5}")
+    )
+
+
+def exporter_cote_mongo(coll):
+    # Cinq aggregate() indépendants : un thread et une connexion chacun
+    taches = [
+        exporter_mongo_t1,
+        exporter_mongo_t2,
+        exporter_mongo_t3,
+        exporter_mongo_t4,
+        exporter_mongo_t5,
+    ]
+    with ThreadPoolExecutor(max_workers=len(taches)) as ex:
+        for futur in [ex.submit(tache, coll) for tache in taches]:
+            futur.result()
+
+
+def extraire_tranche(coll, options: dict) -> pl.DataFrame:
+    if find_arrow_all:
+        # Valeurs hors schéma mises à null, comme les cast(strict=False)
+        tbl = find_arrow_all(
+            coll,
+            FILTRE_VALIDES,
+            schema=SCHEMA_ARROW,
+            allow_invalid=True,
+            projection=PROJECTION,
+            batch_size=TAILLE_LOT,
+            **options,
         )
-        .group_by("categorie_hote")
-        .agg(pl.col("number_of_reviews").median().alias("mediane_nombre_avis"))
-        .write_csv(f"{OUTDIR}/03_mediane_nombre_avis_par_categorie_hote.csv")
+        return pl.from_arrow(tbl)
+
+    cursor = coll.find(FILTRE_VALIDES, PROJECTION, batch_size=TAILLE_LOT, **options)
+
+    # Une liste par colonne, remplie au fil du curseur (pas de liste de dicts)
+    colonnes = {nom: [] for nom in SCHEMA}
+    ajouts = [(nom, valeurs.append) for nom, valeurs in colonnes.items()]
+    for doc in cursor:
+        for nom, ajouter in ajouts:
+            ajouter(doc.get(nom))
+
+    return pl.DataFrame(colonnes, schema=SCHEMA, strict=False)
+
+
+def extraire(coll, index_kpi: bool) -> pl.DataFrame:
+    # Ordre déterministe pour que les tranches skip/limit ne se recouvrent pas :
+    # celui de l'index couvrant, sinon celui de _id
+    ordre = {"hint": INDEX_KPI} if index_kpi else {"sort": [("_id", 1)]}
+
+    total = coll.estimated_document_count()
+    nb = max(1, min(NB_LECTEURS, math.ceil(total / TAILLE_LOT)))
+    if nb == 1:
+        return extraire_tranche(coll, ordre)
+
+    # La dernière tranche est ouverte : l'estimation peut être en retard
+    taille = math.ceil(total / nb)
+    tranches = [
+        {**ordre, "skip": i * taille, "limit": taille if i < nb - 1 else 0}
+        for i in range(nb)
+    ]
+    with ThreadPoolExecutor(max_workers=nb) as ex:
+        return pl.concat(ex.map(lambda options: extraire_tranche(coll, options), tranches))
+
+
+def preparer_base(coll, index_kpi: bool) -> pl.DataFrame:
+    df = extraire(coll, index_kpi)
+    if df.is_empty():
+        die("Aucun document retourné.")
+
+    # Nettoyage en plan paresseux, matérialisé en une fois par collect()
+    lf = df.lazy()
+
+    # Filtrage fait par MongoDB (FILTRE_VALIDES) ; restent les valeurs hors
+    # schéma, mises à null à la lecture
+    lf = lf.drop_nulls([
+        "last_scraped",
+        "room_type",
+        "availability_30",
+        "neighbourhood_cleansed",
+    ])
+
+    # Typage, KPI, traduction et clés de group_by en un seul with_columns :
+    # Polars évalue ces expressions indépendantes en parallèle, en un passage.
+    # Les clés texte passent en Categorical (hachage d'un code u32).
+    date_releve = pl.col("last_scraped").str.strptime(pl.Date, strict=False)
+    lf = lf.with_columns([
+        ((30 - pl.col("availability_30")) / 30).alias("taux_reservation_30j"),
+        (date_releve.dt.year() * 100 + date_releve.dt.month())
+        .cast(pl.Int32)
+        .alias("cle_mois"),
+        traduire_type_logement().cast(pl.Categorical),
+        pl.col("neighbourhood_cleansed").cast(pl.Categorical),
+        pl.col("host_is_superhost").eq("t").fill_null(False).alias("est_superhote"),
+    ]).drop(["last_scraped", "room_type", "host_is_superhost"])
+
+    # Dates illisibles (strptime non strict)
+    lf = lf.drop_nulls("cle_mois")
+
+    return lf.collect()
+
+
+def empreinte_extraction(coll) -> str:
+    # Le plus récent last_scraped (préfixe de l'index couvrant), le nombre de
+    # documents (métadonnées, sans scan : ajouts/suppressions/réimports) et le schéma
+    dernier = coll.find_one(
+        {},
+        {"_id": 0, "last_scraped": 1},
+        sort=[("last_scraped", -1)],
+    )
+    nb_documents = coll.estimated_document_count()
+    schema = repr((SCHEMA, FILTRE_VALIDES, TRADUCTION_TYPE_LOGEMENT)).encode()
+    return (
+        f"{(dernier or {}).get('last_scraped')}|{nb_documents}"
+        f"|{hashlib.sha256(schema).hexdigest()}"
     )
 
-    # 4
-    (
-        df.group_by("neighbourhood_cleansed")
-        .agg(pl.len().alias("nombre_annonces"))
-        .sort("nombre_annonces", descending=True)
-        .rename({"neighbourhood_cleansed": "quartier"})
-        .write_csv(f"{OUTDIR}/04_densite_logements_par_quartier.csv")
+
+def charger_base(coll, index_kpi: bool) -> pl.DataFrame:
+    if not CACHE_EXTRACTION:
+        return preparer_base(coll, index_kpi)
+
+    cache = Path(OUTDIR) / ".cache_listings.parquet"
+    tampon = cache.with_suffix(".stamp")
+    empreinte = empreinte_extraction(coll)
+
+    if cache.exists() and tampon.exists() and tampon.read_text() == empreinte:
+        try:
+            base_df = pl.read_parquet(cache)
+        except (OSError, pl.exceptions.PolarsError) as e:
+            # Cache corrompu ou tronqué : traité comme absent, reconstruit
+            print(f"[ATTENTION] Cache {cache} illisible, reconstruction : {e}", file=sys.stderr)
+        else:
+            print(f"[INFO] Base lue depuis le cache {cache}")
+            return base_df
+
+    base_df = preparer_base(coll, index_kpi)
+    base_df.write_parquet(cache, compression="zstd")
+    tampon.write_text(empreinte)
+    return base_df
+
+
+def exporter_cote_polars(coll, index_kpi: bool):
+    # Base nettoyée matérialisée une fois, lue en parallèle par les requêtes
+    base_df = charger_base(coll, index_kpi)
+    base = base_df.lazy()
+    # Vue Arrow de la même base pour les médianes et le comptage (t2, t3, t4)
+    tbl = base_df.to_arrow()
+
+    # Pré-agrégat (mois, type, quartier) commun à t1 et t5 : un seul passage
+    # sur la base, les moyennes sont recomposées par somme / effectif
+    pre = (
+        base.group_by(["cle_mois", "type_logement", "neighbourhood_cleansed"])
+        .agg([
+            pl.col("taux_reservation_30j").sum().alias("somme_taux"),
+            pl.len().alias("nb"),
+        ])
+        .collect()
+        .lazy()
+    )
+    taux_moyen = (pl.col("somme_taux").sum() / pl.col("nb").sum()).alias("taux_reservation_moyen")
+
+    # 1
+    t1 = (
+        pre.group_by(["cle_mois", "type_logement"])
+        .agg(taux_moyen)
+        .sort(["cle_mois", "type_logement"])
+        .select([formater_mois(), pl.exclude("cle_mois")])
     )
 
     # 5
-    (
-        df.group_by(["mois", "neighbourhood_cleansed"])
-        .agg(pl.col("taux_reservation_30j").mean().alias("taux_reservation_moyen"))
+    t5 = (
+        pre.group_by(["cle_mois", "neighbourhood_cleansed"])
+        .agg(taux_moyen)
+        # Sélection partielle des TOP_N par mois (top_k), rang calculé ensuite
+        # sur ces seules lignes plutôt qu'en triant chaque mois en entier
+        .group_by("cle_mois")
+        .agg(pl.all().top_k_by("taux_reservation_moyen", TOP_N))
+        .explode(["neighbourhood_cleansed", "taux_reservation_moyen"])
         .with_columns(
             pl.col("taux_reservation_moyen")
             .rank(method="dense", descending=True)
-            .over("mois")
+            .over("cle_mois")
             .alias("rang")
         )
-        .filter(pl.col("rang") <= TOP_N)
         .rename({"neighbourhood_cleansed": "quartier"})
-        .write_csv(f"{OUTDIR}/05_top_quartiers_taux_reservation_par_mois.csv")
+        .select([formater_mois(), pl.exclude("cle_mois")])
     )
 
+    # Écriture en flux, les deux plans en parallèle
+    exports = {
+        FICHIER_T1: t1,
+        FICHIER_T5: t5,
+    }
+    pl.collect_all([
+        t.sink_csv(f"{OUTDIR}/{fichier}", lazy=True)
+        for fichier, t in exports.items()
+    ])
+
+    # 2, 3 et 4 : noyaux pyarrow.compute directement sur les buffers Arrow,
+    # sans plan Polars pour une réduction en une passe
+    avis = tbl["number_of_reviews"]
+    ecrire_csv(f"{OUTDIR}/{FICHIER_T2}", ["mediane_nombre_avis"], [[mediane(avis)]])
+
+    superhote = tbl["est_superhote"]
+    groupes = {True: superhote, False: pc.invert(superhote)}
+    ecrire_csv(f"{OUTDIR}/{FICHIER_T3}", ["categorie_hote", "mediane_nombre_avis"], [
+        [LIBELLES_CATEGORIE_HOTE[cle], mediane(avis.filter(masque))]
+        for cle, masque in groupes.items()
+        if pc.any(masque).as_py()
+    ])
+
+    comptes = pc.value_counts(tbl["neighbourhood_cleansed"])
+    ordre = pc.array_sort_indices(comptes.field("counts"), order="descending")
+    ecrire_csv(f"{OUTDIR}/{FICHIER_T4}", ["quartier", "nombre_annonces"], zip(
+        comptes.field("values").take(ordre).to_pylist(),
+        comptes.field("counts").take(ordre).to_pylist(),
+    ))
+
+
+def main():
+    os.makedirs(OUTDIR, exist_ok=True)
+
+    if NETTOYER_OUTPUTS:
+        nettoyer_outputs(OUTDIR)
+
+    uri = build_mongo_uri()
+
+    # Connexion paresseuse : pas de ping, la première vraie opération
+    # échoue en serverSelectionTimeoutMS si le serveur est injoignable
+    try:
+        client = MongoClient(uri, **MONGO_OPTIONS)
+    except Exception as e:
+        die(f"Connexion MongoDB impossible : {e}")
+
+    coll = client[DB_NAME][COLL_NAME]
+    print(f"[INFO] Mongo | base={DB_NAME} collection={COLL_NAME}")
+
+    try:
+        index_kpi = creer_index_kpi(coll)
+
+        if AGREGATION_MONGO:
+            exporter_cote_mongo(coll)
+        else:
+            exporter_cote_polars(coll, index_kpi)
+    except ConnectionFailure as e:
+        die(f"Connexion MongoDB impossible : {e}")
+    except OperationFailure as e:
+        die(f"Opération MongoDB refusée : {e}")
+
     print(f"[OK] Exports générés dans {OUTDIR}")
 
 